@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os, re, sys, sqlite3, traceback
+import os, re, sys, json, time, fcntl, signal, asyncio, sqlite3, threading, traceback
 import datetime as dt
+from collections import deque
+from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
-from typing import Dict, Tuple, Set, List
+from typing import Dict, FrozenSet, Tuple, Set, List
 
-from playwright.sync_api import sync_playwright, TimeoutError as PWTimeoutError
+from playwright.async_api import async_playwright, Error as PWError, TimeoutError as PWTimeoutError
 import requests
+try:
+    import orjson
+except ImportError:  # optional: stdlib json is used when orjson isn't installed
+    orjson = None
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ---------- Config ----------
 GLAD_BASE   = "https://placesleisure.gladstonego.cloud/book/calendar"
@@ -19,6 +31,7 @@ LATEST_HOUR   = int(os.getenv("LATEST_HOUR", "24"))
 WEEKENDS_OK   = os.getenv("WEEKENDS_OK", "true").lower() == "true"
 WEEKDAYS_OK   = os.getenv("WEEKDAYS_OK", "true").lower() == "true"
 SCAN_DAYS     = int(os.getenv("SCAN_DAYS", "45"))
+SCAN_CONCURRENCY = max(1, int(os.getenv("SCAN_CONCURRENCY", "4")))  # pages loaded in parallel
 
 TG_TOKEN    = os.getenv("TG_TOKEN")
 TG_CHAT_ID  = os.getenv("TG_CHAT_ID", "")
@@ -30,14 +43,32 @@ MAX_SLOTS_PER_DATE_SHOWN = int(os.getenv("MAX_SLOTS_PER_DATE_SHOWN", "8"))
 MAX_MSG_CHARS = int(os.getenv("MAX_MSG_CHARS", "3500"))
 FAST_FORWARD_UPDATES = os.getenv("FAST_FORWARD_UPDATES", "true").lower() == "true"
 
+# Daemon mode: >0 keeps one Chromium alive and re-polls every N seconds
+DAEMON_INTERVAL_S = int(os.getenv("DAEMON_INTERVAL_S", "0"))
+# Daemon idle time is spent long-polling getUpdates in chunks of this many seconds (0 = plain sleep).
+# Kept short: SIGTERM only sets a flag, checked between polls, so this bounds shutdown latency
+TG_LONGPOLL_S = int(os.getenv("TG_LONGPOLL_S", "5"))
+# Optional on-disk Chromium profile (e.g. .cache/pw_profile, never under state/); empty = fresh contexts + storage_state
+BROWSER_PROFILE_DIR = os.getenv("BROWSER_PROFILE_DIR", "").strip()
+# DEBUG=1 saves a viewport screenshot of each date that never became ready (DEBUG_FULL=1: full page)
+DEBUG = os.getenv("DEBUG", "0") == "1"
+DEBUG_FULL = os.getenv("DEBUG_FULL", "0") == "1"
+
 # ---------- State (SQLite) ----------
 STATE_DIR = Path("state"); STATE_DIR.mkdir(exist_ok=True)
 DB_FP = STATE_DIR / "slots.sqlite"
 TARGETS_FP = STATE_DIR / "targets.txt"
+# Site session cookies + localStorage, reused between runs on the same machine. Deliberately
+# outside state/: everything there is pushed to the padel-state branch every run
+CACHE_DIR = Path(".cache")
+BROWSER_STATE_FP = CACHE_DIR / "browser_state.json"
+LOCK_FP = STATE_DIR / ".lock"  # dotfile, so the workflow's state/* copy skips it
+DEBUG_DIR = Path("debug")  # uploaded as the debug-screens artifact by the workflow
 
 def _db():
     con = sqlite3.connect(DB_FP)
     con.execute("PRAGMA journal_mode=WAL;")
+    con.execute("PRAGMA synchronous=NORMAL;")  # durable across app crashes under WAL; fsync only at checkpoints
     con.execute("""
         CREATE TABLE IF NOT EXISTS slot_counts(
           slot_key TEXT PRIMARY KEY,
@@ -54,18 +85,24 @@ def _db():
     con.commit()
     return con
 
-def db_get_count(con, key:str) -> int:
-    row = con.execute("SELECT count FROM slot_counts WHERE slot_key=?", (key,)).fetchone()
-    return int(row[0]) if row else 0
+def db_capped_keys(con, limit:int) -> Set[str]:
+    # one query per run; the table only holds today-onwards keys, so this stays small
+    return {k for (k,) in con.execute("SELECT slot_key FROM slot_counts WHERE count >= ?", (limit,))}
 
-def db_inc_count(con, key:str):
+def db_inc_counts(con, keys:List[str]):
     now = dt.datetime.utcnow().isoformat(timespec="seconds")+"Z"
-    con.execute("""
-        INSERT INTO slot_counts(slot_key,count,last_sent_utc)
-        VALUES(?,1,?)
-        ON CONFLICT(slot_key) DO UPDATE SET count=count+1,last_sent_utc=excluded.last_sent_utc
-    """, (key, now))
+    with con:  # single transaction, single commit for the whole batch
+        con.executemany("""
+            INSERT INTO slot_counts(slot_key,count,last_sent_utc)
+            VALUES(?,1,?)
+            ON CONFLICT(slot_key) DO UPDATE SET count=count+1,last_sent_utc=excluded.last_sent_utc
+        """, [(key, now) for key in keys])
+
+def db_prune_counts(con, today_iso: str) -> int:
+    # keys are "YYYY-MM-DD|HH:MM", so a plain string compare drops every past date
+    cur = con.execute("DELETE FROM slot_counts WHERE slot_key < ?", (today_iso,))
     con.commit()
+    return cur.rowcount
 
 def kv_get(con, k:str, default:str|None=None) -> str|None:
     row = con.execute("SELECT v FROM kv WHERE k=?", (k,)).fetchone()
@@ -75,159 +112,411 @@ def kv_set(con, k:str, v:str):
     con.execute("INSERT INTO kv(k,v) VALUES(?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v", (k, v))
     con.commit()
 
+def _is_iso_date(s: str) -> bool:
+    # fromisoformat is a C fast path and also rejects impossible dates like 2025-13-40
+    try: return len(s) == 10 and dt.date.fromisoformat(s).isoformat() == s
+    except ValueError: return False
+
 def load_targets() -> Set[str]:
     if TARGETS_FP.exists():
-        return {ln.strip() for ln in TARGETS_FP.read_text(encoding="utf-8").splitlines() if ln.strip()}
+        return {ln for ln in map(str.strip, TARGETS_FP.read_text(encoding="utf-8").splitlines()) if _is_iso_date(ln)}
     return set()
 
 def save_targets(dates: Set[str]):
-    TARGETS_FP.write_text("\n".join(sorted(dates))+"\n", encoding="utf-8")
+    # write-then-rename so a crash never leaves a truncated targets file
+    tmp = TARGETS_FP.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write("\n".join(sorted(dates))+"\n")
+        f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, TARGETS_FP)
 
 # ---------- Telegram ----------
+TG_API = f"https://api.telegram.org/bot{TG_TOKEN}"
+
+# One keep-alive session so every Telegram call reuses the same TLS connection
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                      max_retries=Retry(total=2, backoff_factor=0.3)))
+# getUpdates gets no read retries: re-sending a long-poll that read-timed out would
+# multiply the wait (and delay shutdown) instead of recovering anything
+SESSION.mount(TG_API + "/getUpdates", HTTPAdapter(pool_connections=1, pool_maxsize=2,
+                                                 max_retries=Retry(total=2, read=0, backoff_factor=0.3)))
+CHAT_ID_SPLIT_RE = re.compile(r"[;,]")
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+def _json_body(payload: dict) -> bytes:
+    if orjson is not None: return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+def _json_loads(raw: bytes):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+# Telegram allows ~30 msg/s per bot and ~1 msg/s per chat; stay under both
+TG_GLOBAL_PER_S = 25
+TG_CHAT_INTERVAL_S = 1.0
+_RATE_LOCK = threading.Lock()
+_RECENT_SENDS: deque = deque()          # monotonic timestamps of sends in the last second
+_LAST_SEND_BY_CHAT: Dict[str, float] = {}
+
+def _rate_limit(cid: str):
+    while True:
+        with _RATE_LOCK:
+            now = time.monotonic()
+            while _RECENT_SENDS and now - _RECENT_SENDS[0] >= 1.0: _RECENT_SENDS.popleft()
+            wait = TG_CHAT_INTERVAL_S - (now - _LAST_SEND_BY_CHAT.get(cid, now - TG_CHAT_INTERVAL_S))
+            if len(_RECENT_SENDS) >= TG_GLOBAL_PER_S: wait = max(wait, 1.0 - (now - _RECENT_SENDS[0]))
+            if wait <= 0:
+                _RECENT_SENDS.append(now); _LAST_SEND_BY_CHAT[cid] = now
+                return
+        time.sleep(wait)
+
+def _retry_after(r) -> float:
+    try: return min(float(_json_loads(r.content)["parameters"]["retry_after"]), 30.0)
+    except Exception: return 1.0
+
 def _post_telegram(payload: dict) -> bool:
-    try:
-        r = requests.post(f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage", json=payload, timeout=20)
+    cid = str(payload.get("chat_id", ""))
+    for attempt in range(2):
+        _rate_limit(cid)
+        try:
+            r = SESSION.post(TG_API + "/sendMessage",
+                             data=_json_body(payload), headers=JSON_HEADERS, timeout=20)
+        except Exception as e:
+            print(f"Telegram send exception: {e}")
+            return False
+        if r.status_code == 429 and attempt == 0:
+            # throttled: honour retry_after once instead of dropping the message. Record the
+            # back-off as this chat's last send so every thread's _rate_limit waits it out
+            with _RATE_LOCK:
+                until = time.monotonic() + _retry_after(r) - TG_CHAT_INTERVAL_S
+                _LAST_SEND_BY_CHAT[cid] = max(_LAST_SEND_BY_CHAT.get(cid, until), until)
+            continue
         if r.status_code != 200:
             print(f"Telegram error {r.status_code}: {r.text[:300]}")
             return False
         return True
-    except Exception as e:
-        print(f"Telegram send exception: {e}")
-        return False
+    return False
+
+def _split_ids(ids: str) -> List[str]:
+    return [c.strip() for c in CHAT_ID_SPLIT_RE.split(ids or "") if c.strip()]
+
+def _send_many(msg: str, cids: List[str]) -> bool:
+    if not TG_TOKEN or not cids: return False
+    send = lambda cid: _post_telegram({"chat_id": cid, "text": msg, "disable_web_page_preview": True})
+    if len(cids) == 1: return send(cids[0])
+    # fan out so N recipients cost ~1 round-trip, not N
+    with ThreadPoolExecutor(max_workers=min(len(cids), 8)) as ex:
+        return any(list(ex.map(send, cids)))
 
 def tg_send(msg: str, chat_ids: str | None = None) -> bool:
-    if not TG_TOKEN: return False
-    ids = (chat_ids or TG_CHAT_ID or "").strip()
-    if not ids: return False
-    ok_any = False
-    for cid in [c.strip() for c in re.split(r"[;,]", ids) if c.strip()]:
-        if _post_telegram({"chat_id": cid, "text": msg, "disable_web_page_preview": True}):
-            ok_any = True
-    return ok_any
-
-def tg_get_updates(offset: int | None):
+    return _send_many(msg, _split_ids(chat_ids or TG_CHAT_ID))
+
+def tg_send_to_all(msg: str, extra_ids: Set[str]) -> bool:
+    # TG_CHAT_ID plus anyone who messaged the bot this run, each chat exactly once
+    return _send_many(msg, list(dict.fromkeys(_split_ids(TG_CHAT_ID) + sorted(extra_ids))))
+
+def tg_get_updates(offset: int | None, poll_s: int = 0):
+    # poll_s > 0 long-polls: Telegram holds the request until an update arrives or it expires
     if not TG_TOKEN: return {"ok": False, "result": []}
-    params = {"limit": 100, "allowed_updates": ["message"]}
+    params = {"limit": 100, "allowed_updates": ["message"], "timeout": poll_s}
     if offset is not None: params["offset"] = offset
     try:
-        r = requests.get(f"https://api.telegram.org/bot{TG_TOKEN}/getUpdates", params=params, timeout=20)
-        return r.json()
+        # a few seconds above the server-side hold, so a dead connection is noticed promptly
+        r = SESSION.get(TG_API + "/getUpdates", params=params, timeout=poll_s + 5 if poll_s else 20)
+        return _json_loads(r.content)
     except Exception:
         return {"ok": False, "result": []}
 
 def tg_ack_until(offset_after: int):
     try:
-        requests.get(f"https://api.telegram.org/bot{TG_TOKEN}/getUpdates",
-                     params={"offset": offset_after, "limit": 1, "allowed_updates": ["message"]}, timeout=10)
+        SESSION.get(TG_API + "/getUpdates",
+                    params={"offset": offset_after, "limit": 1, "allowed_updates": ["message"]}, timeout=10)
     except Exception:
         pass
 
 # ---------- Helpers ----------
 TIME_RANGE_RE = re.compile(r"\b([01]?\d|2[0-3]):([0-5]\d)\s*-\s*([01]?\d|2[0-3]):([0-5]\d)\b")
-TIME_HHMM_RE  = re.compile(r"\b([01]?\d|2[0-3]):([0-5]\d)\b")
 DATE_TOKEN_RE = re.compile(r"\b(\d{4})[-/](\d{2})[-/](\d{2})\b")
-UNAVAILABLE_RE= re.compile(r"(available to book from|fully booked|unavailable)", re.I)
+# Whole-day markers only: safe to treat as "page rendered". A bare "unavailable" can sit
+# in shell/placeholder text before the slot XHRs land, so it only classifies a card
+DAY_CLOSED_RE = re.compile(r"available to book from|fully booked", re.I)
+UNAVAILABLE_RE= re.compile(rf"{DAY_CLOSED_RE.pattern}|unavailable", re.I)
+# One scan per card text: an unavailability marker, or a start time (optionally part of a range)
+SLOT_TEXT_RE  = re.compile(rf"(?P<unavail>{UNAVAILABLE_RE.pattern})"
+                           r"|\b(?P<hh>[01]?\d|2[0-3]):(?P<mm>[0-5]\d)(?P<range>\s*-\s*(?:[01]?\d|2[0-3]):[0-5]\d)?\b", re.I)
 BOOK_NAME_RE  = re.compile(r"\b(book now|book|add to basket)\b", re.I)
+DAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
 
-def normalise_dates(text: str) -> Set[str]:
+@lru_cache(maxsize=512)
+def normalise_dates(text: str) -> FrozenSet[str]:
+    # frozen so the cached result can't be mutated by a caller
     out: Set[str] = set()
-    for y,m,d in DATE_TOKEN_RE.findall(text or ""):
-        try: out.add(dt.date(int(y),int(m),int(d)).isoformat())
-        except ValueError: pass
-    return out
+    for m in DATE_TOKEN_RE.finditer(text or ""):
+        tok = m.group(0).replace("/", "-")  # already YYYY-MM-DD shaped; just validate it
+        if _is_iso_date(tok): out.add(tok)
+    return frozenset(out)
 
+@lru_cache(maxsize=128)
 def _zstamp_for_date(d: dt.date) -> str:
     return f"{d.isoformat()}T{START_HOUR_Z:02d}:00:00.000Z"
 
-def _within_filters(day_dt: dt.date, start_hhmm: str) -> bool:
-    try: hh = int(start_hhmm.split(":")[0])
-    except Exception: return False
-    if not (EARLIEST_HOUR <= hh < LATEST_HOUR): return False
+@lru_cache(maxsize=128)
+def _calendar_url(d: dt.date) -> str:
+    qs = _zstamp_for_date(d)
+    return f"{GLAD_BASE}/{ACTIVITY_ID}?activityDate={qs}&previousActivityDate={qs}"
+
+def _day_allowed(day_dt: dt.date) -> bool:
     is_weekend = day_dt.weekday() >= 5
-    if is_weekend and not WEEKENDS_OK: return False
-    if (not is_weekend) and not WEEKDAYS_OK: return False
-    return True
-
-def _robust_wait(page):
-    try: page.wait_for_load_state("networkidle", timeout=20000)
-    except PWTimeoutError: pass
-    deadline = dt.datetime.now() + dt.timedelta(seconds=12)
-    while dt.datetime.now() < deadline:
-        try:
-            body_txt = page.locator("body").inner_text(timeout=1000)
-            if TIME_RANGE_RE.search(body_txt): return True
-        except Exception: pass
-        if page.get_by_role("button", name=BOOK_NAME_RE).count(): return True
-        if page.get_by_role("link",   name=BOOK_NAME_RE).count(): return True
-        page.wait_for_timeout(400)
-    return False
+    return WEEKENDS_OK if is_weekend else WEEKDAYS_OK
+
+# Evaluated in the page: true once a time range or a whole-day notice is rendered
+# (a not-yet-released or fully booked day shows only the latter), or any Book CTA exists
+READY_JS = """([timeSrc, closedSrc, bookSrc]) => {
+  const timeRe = new RegExp(timeSrc), closedRe = new RegExp(closedSrc, "i"), bookRe = new RegExp(bookSrc, "i");
+  // innerText forces layout, so read only the main content region when the page has one
+  const root = document.querySelector("main, [role=main]") || document.body;
+  const text = (root && root.innerText) || "";
+  if (timeRe.test(text) || closedRe.test(text)) return true;
+  for (const el of document.querySelectorAll('button, a, [role="button"], [role="link"]'))
+    if (bookRe.test((el.getAttribute("aria-label") || el.innerText || "").trim())) return true;
+  return false;
+}"""
+
+async def _robust_wait(page):
+    # no networkidle wait first: the SPA keeps polling/analytics traffic alive, so idle
+    # often never comes and only burned its timeout; the content check alone decides
+    try:
+        await page.wait_for_function(READY_JS, arg=[TIME_RANGE_RE.pattern, DAY_CLOSED_RE.pattern, BOOK_NAME_RE.pattern],
+                               polling=250, timeout=20000)
+        return True
+    except PWTimeoutError:
+        return False
 
-def _button_scoped_time(button):
-    for depth in range(1,6):
-        try:
-            cont = button.locator(f"xpath=ancestor::*[{depth}]")
-            txt = (cont.inner_text(timeout=600) or "").strip()
-        except Exception:
-            continue
-        if not txt or UNAVAILABLE_RE.search(txt): continue
-        m = TIME_RANGE_RE.search(txt) or TIME_HHMM_RE.search(txt)
-        if m:
-            hh = m.group(1).zfill(2); mm = m.group(2)
-            return f"{hh}:{mm}"
-    return None
-
-def _iter_bookable_slots(page, d: dt.date):
-    slots = []
-    ctas = []
-    for loc in (page.get_by_role("button", name=BOOK_NAME_RE),
-                page.get_by_role("link",   name=BOOK_NAME_RE)):
-        for i in range(min(loc.count(), 400)):
-            el = loc.nth(i)
+# JS flavour of SLOT_TEXT_RE (named groups are spelled (?<name>) there)
+SLOT_TEXT_JS_SRC = SLOT_TEXT_RE.pattern.replace("(?P<", "(?<")
+
+# One round-trip per page: for every visible, enabled Book CTA, walk up to five
+# ancestors (nearest first) and take the first one whose text has a start time and
+# no unavailability marker. Hour bounds are applied in-page, so only the surviving
+# "HH:MM" strings come back. Bails out early when the page has no Book text anywhere.
+CTA_STARTS_JS = """([bookSrc, slotSrc, earliest, latest]) => {
+  const bookRe = new RegExp(bookSrc, "i"), slotRe = new RegExp(slotSrc, "gi");
+  const starts = new Set();
+  // cheap whole-page check first: fully booked days have no Book text at all. Plain
+  // substring test, not bookRe, since siblings can render glued ("11:00Book"); innerText
+  // rather than textContent so script/JSON bodies (full of "book") don't defeat it.
+  // aria-labels are only collected when the visible text has no match
+  const anyBookRe = /book|add to basket/i;
+  if (!anyBookRe.test(document.body.innerText || "") &&
+      !Array.from(document.querySelectorAll("[aria-label]")).some(e => anyBookRe.test(e.getAttribute("aria-label"))))
+    return [];
+  let seen = 0;
+  for (const el of document.querySelectorAll('button, a, [role="button"], [role="link"]')) {
+    const name = (el.getAttribute("aria-label") || el.innerText || "").trim();
+    if (!bookRe.test(name)) continue;
+    if (el.disabled || el.hasAttribute("disabled")) continue;
+    const aria = (el.getAttribute("aria-disabled") || "").toLowerCase();
+    if (aria === "true" || aria === "1") continue;
+    if (!el.getClientRects().length || getComputedStyle(el).visibility === "hidden") continue;
+    if (++seen > 800) break;
+    for (let p = el.parentElement, depth = 0; p && depth < 5; p = p.parentElement, depth++) {
+      let first = null, range = null, blocked = false;
+      // matchAll clones slotRe, so the shared instance's lastIndex never leaks between texts
+      for (const m of (p.innerText || "").matchAll(slotRe)) {
+        if (m.groups.unavail) { blocked = true; break; }
+        if (!first) first = m;
+        if (!range && m.groups.range) range = m;
+      }
+      const m = blocked ? null : (range || first);
+      if (!m) continue;
+      const hh = parseInt(m.groups.hh, 10);
+      if (hh >= earliest && hh < latest) starts.add(String(hh).padStart(2, "0") + ":" + m.groups.mm);
+      break;
+    }
+  }
+  return Array.from(starts);
+}"""
+
+async def _iter_bookable_slots(page, d: dt.date):
+    try: starts = await page.evaluate(CTA_STARTS_JS, [BOOK_NAME_RE.pattern, SLOT_TEXT_JS_SRC,
+                                                      EARLIEST_HOUR, LATEST_HOUR])
+    except Exception: starts = []
+
+    iso, day, url = d.isoformat(), DAY_NAMES[d.weekday()], _calendar_url(d)
+    return [(iso, day, start, "Padel Tennis", url) for start in sorted(starts)]
+
+# ---------- Browser (launched once, one fresh context per worker per scan) ----------
+# Playwright objects are bound to the loop that created them, so keep one for the process
+_LOOP = asyncio.new_event_loop()
+_PW = None
+_BROWSER = None
+_PROFILE_CTX = None
+
+async def _playwright():
+    global _PW
+    if _PW is None: _PW = await async_playwright().start()
+    return _PW
+
+async def _get_browser():
+    global _BROWSER
+    # a crashed or disconnected Chromium is relaunched rather than failing every later poll
+    if _BROWSER is not None and not _BROWSER.is_connected(): _BROWSER = None
+    if _BROWSER is None:
+        _BROWSER = await (await _playwright()).chromium.launch(headless=True, args=["--no-sandbox"])
+    return _BROWSER
+
+async def _get_profile_context():
+    # BROWSER_PROFILE_DIR mode: one on-disk profile shared by all workers, so the HTTP
+    # cache and TLS session tickets survive restarts; cookies live in the profile too
+    global _PROFILE_CTX
+    if _PROFILE_CTX is None:
+        _PROFILE_CTX = await (await _playwright()).chromium.launch_persistent_context(
+            BROWSER_PROFILE_DIR, headless=True, args=["--no-sandbox"], service_workers="block")
+        # a persistent context has no Browser handle to probe; "close" also fires on a crash
+        _PROFILE_CTX.on("close", _forget_profile_context)
+        await _PROFILE_CTX.route("**/*", _block_noise)
+    return _PROFILE_CTX
+
+def _forget_profile_context(ctx):
+    global _PROFILE_CTX
+    if _PROFILE_CTX is ctx: _PROFILE_CTX = None
+
+async def _close_browser():
+    global _PW, _BROWSER, _PROFILE_CTX
+    # each step on its own: after a crash the first close is the likeliest to fail, and
+    # skipping _PW.stop() would leak a driver process per relaunch in daemon mode
+    with suppress(Exception):
+        if _PROFILE_CTX is not None: await _PROFILE_CTX.close()
+    with suppress(Exception):
+        if _BROWSER is not None: await _BROWSER.close()
+    with suppress(Exception):
+        if _PW is not None: await _PW.stop()
+    _PW = _BROWSER = _PROFILE_CTX = None
+
+def close_browser():
+    _LOOP.run_until_complete(_close_browser())
+
+# Never read by the scraper; stylesheets stay enabled because CTA visibility depends on them
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+BLOCKED_HOSTS = ("google-analytics", "googletagmanager", "hotjar", "doubleclick", "facebook.net")
+
+async def _block_noise(route, request):
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or any(h in request.url for h in BLOCKED_HOSTS):
+        return await route.abort()
+    return await route.continue_()
+
+@lru_cache(maxsize=1)
+def _scan_dates_for(today: dt.date) -> Tuple[dt.date, ...]:
+    # filtered-out weekdays are dropped here so their pages are never loaded
+    days = (today + dt.timedelta(days=offset) for offset in range(SCAN_DAYS+1))
+    return tuple(d for d in days if _day_allowed(d))
+
+def scan_dates() -> Tuple[dt.date, ...]:
+    # keyed on today's date, so a daemon recomputes only when the day rolls over
+    return _scan_dates_for(dt.date.today())
+
+async def _take_debug(page, d: dt.date):
+    # off by default: a full-page capture forces layout and paint of the whole SPA
+    if not DEBUG: return
+    try:
+        DEBUG_DIR.mkdir(exist_ok=True)
+        await page.screenshot(path=str(DEBUG_DIR / f"{d.isoformat()}.png"), full_page=DEBUG_FULL)
+    except Exception as e:
+        print(f"Could not save debug screenshot for {d.isoformat()}: {e}")
+
+def _load_browser_state():
+    # a missing or unreadable file (e.g. a run killed mid-write) just means a cold start
+    try: return json.loads(BROWSER_STATE_FP.read_bytes())
+    except FileNotFoundError: return None
+    except Exception as e:
+        print(f"Ignoring unreadable browser state: {e}"); return None
+
+async def _save_browser_state(ctx):
+    # write-then-rename, as in save_targets, so a killed run never leaves a truncated file
+    try:
+        state = await ctx.storage_state()
+        CACHE_DIR.mkdir(exist_ok=True)
+        tmp = BROWSER_STATE_FP.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(_json_body(state)); f.flush(); os.fsync(f.fileno())
+        os.replace(tmp, BROWSER_STATE_FP)
+    except Exception as e:
+        print(f"Could not save browser state: {e}")
+
+async def _open_context(browser):
+    # returns (ctx, owned); an owned context is closed by the worker, the profile one is shared
+    if browser is None: return _PROFILE_CTX, False
+    # contexts start from the saved cookies/localStorage so the SPA boots warm
+    # service workers would fetch assets outside ctx.route, so keep them off
+    state = _load_browser_state()
+    try: ctx = await browser.new_context(storage_state=state, service_workers="block")
+    except PWError:
+        if state is None: raise
+        print("Saved browser state was rejected; starting cold.")
+        ctx = await browser.new_context(service_workers="block")
+    await ctx.route("**/*", _block_noise)
+    return ctx, True
+
+async def _scan_worker(browser, dates, out: List, save_state: bool = False):
+    # each worker owns a page and pulls dates from the shared iterator
+    ctx, owned = await _open_context(browser)
+    page = await ctx.new_page()
+    try:
+        for d in dates:
             try:
-                if not (el.is_visible() and el.is_enabled()): continue
-                if el.get_attribute("disabled") is not None: continue
-                if (el.get_attribute("aria-disabled") or "").lower() in ("true","1"): continue
-            except Exception:
-                continue
-            ctas.append(el)
-
-    seen = set()
-    for el in ctas:
-        start = _button_scoped_time(el)
-        if not start: continue
-        if not _within_filters(d, start): continue
-        if start in seen: continue
-        qs = _zstamp_for_date(d)
-        url = f"{GLAD_BASE}/{ACTIVITY_ID}?activityDate={qs}&previousActivityDate={qs}"
-        slots.append((d.isoformat(), d.strftime("%A"), start, "Padel Tennis", url))
-        seen.add(start)
-
-    slots.sort(key=lambda x:(x[0],x[2]))
-    return slots
-
-def collect_slots():
-    today = dt.date.today()
-    all_slots = []
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True, args=["--no-sandbox"])
-        ctx = browser.new_context(); page = ctx.new_page()
-        for offset in range(SCAN_DAYS+1):
-            d = today + dt.timedelta(days=offset)
-            url = f"{GLAD_BASE}/{ACTIVITY_ID}?activityDate={_zstamp_for_date(d)}&previousActivityDate={_zstamp_for_date(d)}"
-            page.goto(url, timeout=60000)
-            if not _robust_wait(page): continue
-            all_slots.extend(_iter_bookable_slots(page, d))
-        ctx.close(); browser.close()
-    # global de-dupe by (date,time)
-    seen, uniq = set(), []
-    for s in all_slots:
-        k = (s[0],s[2])
-        if k not in seen:
-            uniq.append(s); seen.add(k)
-    uniq.sort(key=lambda x:(x[0],x[2]))
-    return uniq
+                # return once the response is committed; _robust_wait decides when content is there
+                try: await page.goto(_calendar_url(d), wait_until="commit", timeout=60000)
+                except PWTimeoutError:
+                    print(f"Timed out loading {d.isoformat()}; skipping."); continue
+                if not await _robust_wait(page):
+                    await _take_debug(page, d); continue
+                out.extend(await _iter_bookable_slots(page, d))
+            except PWError as e:
+                # net::ERR_*, a crashed tab, ...: lose this date, not the whole scan
+                print(f"Error loading {d.isoformat()}: {e}; skipping.")
+                # a crashed page stays unusable, so carry on with a fresh one
+                try: await page.close()
+                except PWError: pass
+                page = await ctx.new_page()
+        if save_state and owned: await _save_browser_state(ctx)
+    finally:
+        try: await (ctx.close() if owned else page.close())
+        except PWError: pass  # already gone with a crashed browser
+
+async def _collect_slots_async(target_dates: Set[str] | None):
+    dates = scan_dates()
+    if target_dates: dates = tuple(d for d in dates if d.isoformat() in target_dates)
+    if not dates: return []
+    # launch before fanning out so concurrent workers never race to start a second browser
+    if BROWSER_PROFILE_DIR: await _get_profile_context(); browser = None
+    else: browser = await _get_browser()
+    it, all_slots = iter(dates), []
+    workers = [asyncio.ensure_future(_scan_worker(browser, it, all_slots, save_state=(i == 0)))
+               for i in range(min(SCAN_CONCURRENCY, len(dates)))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        # otherwise the siblings linger on _LOOP and resume during the next poll,
+        # still draining this scan's iterator (and worker 0 still saving state)
+        for w in workers: w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    return all_slots
+
+def collect_slots(target_dates: Set[str] | None = None):
+    # with targets set, only those dates are loaded; otherwise the whole window
+    try: all_slots = _LOOP.run_until_complete(_collect_slots_async(target_dates))
+    except Exception:
+        # drop whatever the failed scan left behind (dead browser, dead driver);
+        # the next poll launches a fresh one instead of reusing a broken handle
+        close_browser(); raise
+    # each date is scanned once and its starts are already unique, so no de-dupe pass
+    all_slots.sort(key=lambda x:(x[0],x[2]))
+    return all_slots
 
 # ---------- Telegram commands ----------
+@lru_cache(maxsize=512)
 def _normalise_command(text: str) -> Tuple[str, str]:
     t = (text or "").strip()
     if not t: return "", ""
@@ -241,6 +530,32 @@ def _normalise_command(text: str) -> Tuple[str, str]:
         first = cmd
     return first.lower(), (rest[0] if rest else "")
 
+# Command handlers mutate the shared targets set in place; handle_commands persists it
+def _cmd_want(targets: Set[str], tail: str, chat_id: str):
+    parsed = normalise_dates(tail)
+    if parsed:
+        targets |= parsed
+        tg_send("Saved target date(s):\n" + "\n".join(sorted(parsed)) +
+                "\n\nWatching:\n" + ("\n".join(sorted(targets)) if targets else "None"), chat_id)
+    else:
+        tg_send("I couldn’t read any dates. Use YYYY-MM-DD or YYYY/MM/DD.", chat_id)
+
+def _cmd_clear(targets: Set[str], tail: str, chat_id: str):
+    targets.clear(); tg_send("Cleared targets.", chat_id)
+
+def _cmd_list(targets: Set[str], tail: str, chat_id: str):
+    tg_send("Watching:\n" + ("\n".join(sorted(targets)) if targets else "No targets set."), chat_id)
+
+def _cmd_help(targets: Set[str], tail: str, chat_id: str):
+    tg_send("Commands:\n/want YYYY-MM-DD …\n/add YYYY-MM-DD …\n/list\n/clear\n(Notifications limited to 2 per slot.)", chat_id)
+
+COMMANDS = {
+    "/want": _cmd_want, "/add": _cmd_want,
+    "/clear": _cmd_clear,
+    "/list": _cmd_list,
+    "/help": _cmd_help, "/start": _cmd_help,
+}
+
 def handle_commands(con) -> Tuple[Set[str], Set[str]]:
     targets = load_targets()
     last_id_s = kv_get(con, "tg_last_update_id", None)
@@ -271,62 +586,65 @@ def handle_commands(con) -> Tuple[Set[str], Set[str]]:
         if not cmd: continue
         notify_ids.add(chat_id)
 
-        if cmd in ("/want","/add"):
-            parsed = normalise_dates(tail)
-            if parsed:
-                targets |= parsed
-                save_targets(targets)
-                tg_send("Saved target date(s):\n" + "\n".join(sorted(parsed)) +
-                        "\n\nWatching:\n" + ("\n".join(sorted(targets)) if targets else "None"), chat_id)
-            else:
-                tg_send("I couldn’t read any dates. Use YYYY-MM-DD or YYYY/MM/DD.", chat_id)
-
-        elif cmd=="/clear":
-            targets.clear(); save_targets(targets); tg_send("Cleared targets.", chat_id)
-
-        elif cmd=="/list":
-            tg_send("Watching:\n" + ("\n".join(sorted(targets)) if targets else "No targets set."), chat_id)
-
-        elif cmd in ("/help","/start"):
-            tg_send("Commands:\n/want YYYY-MM-DD …\n/add YYYY-MM-DD …\n/list\n/clear\n(Notifications limited to 2 per slot.)", chat_id)
+        handler = COMMANDS.get(cmd)
+        if handler: handler(targets, tail, chat_id)
 
+    # targets are written once per batch, together with the update offset
+    save_targets(targets)
     kv_set(con,"tg_last_update_id",str(max_id))
     tg_ack_until(max_id+1)
-    save_targets(targets)
     return targets, notify_ids
 
 # ---------- Message building (display +1h) ----------
-def build_date_messages(date_iso: str, entries: List[Tuple[str,str,str,str,str]]) -> List[str]:
-    day = entries[0][1]; total = len(entries)
-    header = f"Padel availability — {date_iso} ({day})\n"
-    lines, shown = [], 0
-    for _,_,time_s,act,url in entries:
-        if shown >= MAX_SLOTS_PER_DATE_SHOWN: break
-        # +1 hour for display only
-        try:
-            hh, mm = map(int, time_s.split(":"))
-            hh = (hh + 1) % 24
-            display_time = f"{hh:02d}:{mm:02d}"
-        except Exception:
-            display_time = time_s
-        lines.append(f"• {display_time} — {act}\n  {url}")
-        shown += 1
-    if total > MAX_SLOTS_PER_DATE_SHOWN:
-        lines.append(f"…and {total - MAX_SLOTS_PER_DATE_SHOWN} more")
-    msgs, cur = [], header
-    for line in lines:
-        if len(cur)+len(line)+1 > MAX_MSG_CHARS:
-            msgs.append(cur.rstrip()); cur = header+"(continued)\n"+line+"\n"
-        else:
-            cur += line+"\n"
-    if cur.strip(): msgs.append(cur.rstrip())
+def _display_time(time_s: str) -> str:
+    # +1 hour for display only
+    try:
+        hh, mm = map(int, time_s.split(":"))
+        return f"{(hh + 1) % 24:02d}:{mm:02d}"
+    except Exception:
+        return time_s
+
+def build_messages(eligible_by_date: Dict[str, List[Tuple[str,str,str,str,str]]]) -> List[Tuple[str, List[str]]]:
+    """Pack all dates into as few MAX_MSG_CHARS chunks as possible.
+
+    Returns (text, slot_keys) pairs; slot_keys are the "date|time" keys shown in
+    that chunk, so counters are only bumped for slots that were actually sent.
+    """
+    msgs: List[Tuple[str, List[str]]] = []
+    parts: List[str] = []; keys: List[str] = []; size = 0
+    for date_iso, entries in eligible_by_date.items():  # insertion order is date order
+        header = f"Padel availability — {date_iso} ({entries[0][1]})\n"
+        lines = [(f"• {_display_time(time_s)} — {act}\n  {url}", f"{iso}|{time_s}")
+                 for iso,_,time_s,act,url in entries[:MAX_SLOTS_PER_DATE_SHOWN]]
+        if len(entries) > MAX_SLOTS_PER_DATE_SHOWN:
+            lines.append((f"…and {len(entries) - MAX_SLOTS_PER_DATE_SHOWN} more", None))
+
+        # start the date's section in this chunk if its header + first line fit
+        lead = ("\n" if parts else "") + header
+        if parts and size + len(lead) + len(lines[0][0]) + 1 > MAX_MSG_CHARS:
+            msgs.append(("".join(parts).rstrip(), keys)); parts, keys, size = [], [], 0
+            lead = header
+        parts.append(lead); size += len(lead)
+
+        cont = header + "(continued)\n"
+        for line, key in lines:
+            n = len(line) + 1
+            if size + n > MAX_MSG_CHARS:
+                msgs.append(("".join(parts).rstrip(), keys)); parts, keys, size = [cont], [], len(cont)
+            parts += (line, "\n"); size += n
+            if key: keys.append(key)
+    if parts: msgs.append(("".join(parts).rstrip(), keys))
     return msgs
 
 # ---------- Main ----------
-def main():
-    try:
-        con = _db()
+_STOP = threading.Event()
+
+def _request_stop(signum, frame):
+    print(f"Signal {signum} received; stopping after current poll.")
+    _STOP.set()
 
+def run_once(con) -> int:
+    try:
         targets, notify_ids = handle_commands(con)
 
         # prune past targets
@@ -336,41 +654,26 @@ def main():
             save_targets(tset)
             if targets - tset:
                 tg_send("Removed past target dates:\n" + "\n".join(sorted(targets - tset)))
+        db_prune_counts(con, today_iso)
 
-        slots = collect_slots()
-        if tset:
-            slots = [s for s in slots if s[0] in tset]
+        slots = collect_slots(tset)
         if not slots:
             print("No matching slots."); return 0
 
-        # group by date
-        by_date: Dict[str, List[Tuple[str,str,str,str,str]]] = {}
-        for iso,day,time_s,act,url in slots:
-            by_date.setdefault(iso, []).append((iso,day,time_s,act,url))
-        for iso in list(by_date.keys()):
-            by_date[iso].sort(key=lambda x:x[2])
-
-        # filter by per-slot cap via SQLite
+        # slots arrive sorted by (date,time): group and apply the per-slot cap in one pass
+        capped = db_capped_keys(con, NOTIFY_LIMIT_PER_SLOT)
         eligible_by_date: Dict[str, List[Tuple[str,str,str,str,str]]] = {}
-        for d, items in by_date.items():
-            elig=[]
-            for iso,day,time_s,act,url in items:
-                key = f"{iso}|{time_s}"
-                if db_get_count(con, key) < NOTIFY_LIMIT_PER_SLOT:
-                    elig.append((iso,day,time_s,act,url))
-            if elig:
-                eligible_by_date[d]=elig
+        for iso, items in groupby(slots, key=itemgetter(0)):
+            elig = [s for s in items if f"{iso}|{s[2]}" not in capped]
+            if elig: eligible_by_date[iso] = elig
 
         if not eligible_by_date:
             print("Slots exist but all are beyond the per-slot limit; no messages sent.")
             return 0
 
-        # send & increment
-        for d in sorted(eligible_by_date.keys()):
-            for piece in build_date_messages(d, eligible_by_date[d]):
-                tg_send(piece);  [tg_send(piece, cid) for cid in notify_ids]
-            for iso,_,time_s,_,_ in eligible_by_date[d]:
-                db_inc_count(con, f"{iso}|{time_s}")
+        # one combined message (chunked) per run; count only what was delivered
+        for text, keys in build_messages(eligible_by_date):
+            if tg_send_to_all(text, notify_ids): db_inc_counts(con, keys)
 
         print("Sent notifications.")
         return 0
@@ -380,5 +683,54 @@ def main():
         traceback.print_exc(limit=2)
         return 1
 
+def _idle_until_next_run(con, seconds: int, peeked_id: int) -> int:
+    # a command arriving mid-interval starts the next run at once; updates are only peeked
+    # here (the offset is not advanced), so handle_commands still sees and acks them.
+    # Returns the newest update_id peeked, to be passed back in on the next call.
+    deadline = time.monotonic() + seconds
+    while not _STOP.is_set():
+        left = deadline - time.monotonic()
+        if left <= 0: break
+        if not TG_TOKEN or TG_LONGPOLL_S <= 0:
+            _STOP.wait(left); break
+        last_id_s = kv_get(con, "tg_last_update_id", None)
+        offset = int(last_id_s)+1 if (last_id_s and last_id_s.isdigit()) else None
+        res = tg_get_updates(offset, poll_s=max(1, min(int(left), TG_LONGPOLL_S)))
+        newest = max((u.get("update_id", 0) for u in res.get("result") or ()), default=0)
+        if newest > peeked_id: return newest
+        if newest:
+            # only updates already peeked: the last run failed before acking them, so
+            # they would come straight back on every poll; wait out the interval instead
+            _STOP.wait(left); break
+        if not res.get("ok"): _STOP.wait(min(left, 5))  # API/network error: don't spin
+    return peeked_id
+
+def main():
+    # a profile holds the site's cookies/session; state/ is pushed to the padel-state branch
+    if BROWSER_PROFILE_DIR and Path(BROWSER_PROFILE_DIR).resolve().is_relative_to(STATE_DIR.resolve()):
+        print(f"BROWSER_PROFILE_DIR ({BROWSER_PROFILE_DIR}) is under {STATE_DIR}/, which is published; "
+              "use e.g. .cache/pw_profile. Refusing to start.")
+        return 2
+    # one checker per state dir: an overlapping run would scrape twice and double-notify
+    lock = open(LOCK_FP, "a+")  # not "w": don't wipe the holder's pid before we own the lock
+    try: fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close(); print("Another checker run holds the lock; exiting."); return 0
+    lock.seek(0); lock.truncate(); lock.write(f"{os.getpid()}\n"); lock.flush()
+
+    con = _db()
+    try:
+        if DAEMON_INTERVAL_S <= 0:
+            return run_once(con)
+        signal.signal(signal.SIGTERM, _request_stop)
+        signal.signal(signal.SIGINT, _request_stop)
+        peeked_id = 0
+        while not _STOP.is_set():
+            run_once(con)
+            peeked_id = _idle_until_next_run(con, DAEMON_INTERVAL_S, peeked_id)
+        return 0
+    finally:
+        close_browser(); con.close(); lock.close()
+
 if __name__ == "__main__":
     sys.exit(main())
\ No newline at end of file